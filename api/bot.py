@@ -1,15 +1,21 @@
 import asyncio
 import os
 import re
-import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import urlsplit
 import aiohttp
 import yt_dlp
+from diskcache import Cache
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
-from aiogram.types import Message, BufferedInputFile
+from aiogram.types import Message, FSInputFile
 from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.enums import ChatAction, ParseMode
 from aiogram.fsm.storage.memory import MemoryStorage
 import logging
 from dotenv import load_dotenv
@@ -29,47 +35,143 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable is not set")
 
+# Shared HTTP session so warm instances reuse keep-alive connections
+session = AiohttpSession()
+session._connector_init.update(
+    limit=100,
+    limit_per_host=50,
+    keepalive_timeout=75,
+    ttl_dns_cache=300
+)
+
 # Initialize bot and dispatcher
 bot = Bot(
     token=BOT_TOKEN, 
+    session=session,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
 dp = Dispatcher(storage=MemoryStorage())
 
+# Dedicated thread pool for blocking yt-dlp downloads
+DOWNLOAD_POOL_SIZE = int(os.getenv("DOWNLOAD_POOL_SIZE", "4"))
+download_pool = ThreadPoolExecutor(
+    max_workers=DOWNLOAD_POOL_SIZE,
+    thread_name_prefix="ytdlp"
+)
+
+# Persistent scratch directory for downloads (/tmp is writable on Vercel)
+SCRATCH_DIR = '/tmp/sc'
+os.makedirs(SCRATCH_DIR, exist_ok=True)
+
+# Cache of already uploaded tracks, keyed by canonical SoundCloud URL
+TRACK_CACHE_TTL = 7 * 24 * 60 * 60  # 7 days
+track_cache = Cache('/tmp/sc_cache', size_limit=500 * 1024 * 1024)
+
+def make_cache_key(url: str) -> str:
+    """Normalise a SoundCloud URL so variants of one link share a cache entry."""
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    # Query string and fragment don't identify the track
+    return f"{parts.scheme.lower()}://{host}{parts.path.rstrip('/')}"
+
+# In-process LRU in front of the disk cache for the hottest tracks
+FILE_ID_CACHE_SIZE = 1024
+file_id_cache = OrderedDict()
+
+def remember_track(cache_key: str, entry: dict):
+    """Store a track entry in the in-process LRU cache."""
+    file_id_cache[cache_key] = entry
+    file_id_cache.move_to_end(cache_key)
+    if len(file_id_cache) > FILE_ID_CACHE_SIZE:
+        file_id_cache.popitem(last=False)
+
+async def get_cached_track(cache_key: str):
+    """Look up an uploaded track, checking memory before disk."""
+    entry = file_id_cache.get(cache_key)
+    if entry:
+        file_id_cache.move_to_end(cache_key)
+        return entry
+    entry = await asyncio.to_thread(track_cache.get, cache_key)
+    if entry:
+        remember_track(cache_key, entry)
+    return entry
+
 # SoundCloud URL regex
 SOUNDCLOUD_REGEX = re.compile(
-    r'https?://(?:www\.)?soundcloud\.com/[\w\-\.]+/[\w\-\.]+'
+    r'https?://(?:www\.)?soundcloud\.com/[\w\-\.]+/[\w\-\.]+',
+    re.IGNORECASE
 )
 
+# Keywords that hint the user is trying to send a link
+KEYWORD_REGEX = re.compile(r'soundcloud|ссылк|скача|трек', re.IGNORECASE)
+
+# Telegram bot API upload limit
+MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+
+# Read size used when streaming audio to Telegram
+UPLOAD_CHUNK_SIZE = 256 * 1024  # 256KB
+
+class FileTooLargeError(Exception):
+    """Raised when a track exceeds the Telegram upload limit."""
+
+# Base yt-dlp options, built once and shared by all downloads
+YDL_OPTS = {
+    # SoundCloud serves MP3 directly, so no transcoding is needed
+    'format': 'http_mp3_128/hls_mp3_128/bestaudio[ext=mp3]/bestaudio/best',
+    'postprocessors': [],
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': False,
+    'writeinfojson': False,
+    'writethumbnail': False,
+    'socket_timeout': 30,
+    'retries': 3,
+    'fragment_retries': 3,
+    # Abort oversized downloads instead of fetching the whole file
+    'max_filesize': MAX_FILE_SIZE,
+    # Keep extractor caches between downloads on a warm instance
+    'cachedir': '/tmp/ytdlp-cache',
+    'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'referer': 'https://soundcloud.com/',
+    # Add headers to avoid blocking
+    'http_headers': {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Accept-Language': 'en-us,en;q=0.5',
+        'Accept-Encoding': 'gzip,deflate',
+        'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.7',
+        'Keep-Alive': '300',
+        'Connection': 'keep-alive',
+    }
+}
+
 class SoundCloudDownloader:
     def __init__(self):
-        self.ydl_opts = {
-            'format': 'best[ext=mp3]/best[acodec=mp3]/best[abr<=320]/best',
-            'outtmpl': '%(title)s.%(ext)s',
-            'extractaudio': True,
-            'audioformat': 'mp3',
-            'audioquality': '192',
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'writeinfojson': False,
-            'writethumbnail': False,
-            'socket_timeout': 30,
-            'retries': 3,
-            'fragment_retries': 3,
-            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'referer': 'https://soundcloud.com/',
-            # Add headers to avoid blocking
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-us,en;q=0.5',
-                'Accept-Encoding': 'gzip,deflate',
-                'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.7',
-                'Keep-Alive': '300',
-                'Connection': 'keep-alive',
-            }
-        }
+        self.ydl_opts = YDL_OPTS
+        # One YoutubeDL per worker thread, since instances aren't thread-safe
+        self._local = threading.local()
+        # Every instance created, so they can be closed on shutdown
+        self._instances = []
+        self._instances_lock = threading.Lock()
+    
+    def _get_ydl(self) -> yt_dlp.YoutubeDL:
+        """Return this thread's YoutubeDL instance, creating it on first use."""
+        ydl = getattr(self._local, 'ydl', None)
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL(self.ydl_opts.copy())
+            self._local.ydl = ydl
+            with self._instances_lock:
+                self._instances.append(ydl)
+        return ydl
+    
+    def close(self):
+        """Close every YoutubeDL instance created by the download threads."""
+        with self._instances_lock:
+            for ydl in self._instances:
+                ydl.close()
+            self._instances.clear()
     
     def sanitize_filename(self, filename):
         """Clean filename for cross-platform compatibility."""
@@ -82,54 +184,40 @@ class SoundCloudDownloader:
             filename = filename[:200]
         return filename
     
-    async def download_track(self, url: str, temp_dir: str) -> tuple[str, dict]:
+    async def download_track(self, url: str, file_stem: str) -> tuple[str, dict]:
         """Download track from SoundCloud."""
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         
         def _download():
             try:
-                with yt_dlp.YoutubeDL(self.ydl_opts) as ydl:
-                    # First, extract info without downloading
-                    info = ydl.extract_info(url, download=False)
-                    
-                    if not info:
-                        raise Exception("Could not extract track information")
-                    
-                    # Clean the title for filename
-                    title = info.get('title', 'track')
-                    clean_title = self.sanitize_filename(title)
-                    
-                    # Prepare filename
-                    filename = f"{clean_title}.mp3"
-                    filepath = os.path.join(temp_dir, filename)
-                    
-                    # Update options for download
-                    download_opts = self.ydl_opts.copy()
-                    download_opts['outtmpl'] = filepath
-                    
-                    # Download the track
-                    with yt_dlp.YoutubeDL(download_opts) as ydl_download:
-                        ydl_download.download([url])
-                    
-                    # Check if file was actually created
-                    if not os.path.exists(filepath):
-                        # Try to find the downloaded file with different extension
-                        for ext in ['.mp3', '.m4a', '.opus', '.webm']:
-                            alt_path = os.path.join(temp_dir, f"{clean_title}{ext}")
-                            if os.path.exists(alt_path):
-                                # Rename to .mp3
-                                os.rename(alt_path, filepath)
-                                break
-                        else:
-                            raise FileNotFoundError(f"Downloaded file not found: {filepath}")
-                    
-                    return filepath, info
-                    
+                # Reuse the warm instance, writing into the shared scratch directory
+                ydl = self._get_ydl()
+                ydl.params['outtmpl'] = {
+                    'default': os.path.join(SCRATCH_DIR, f'{file_stem}.%(ext)s')
+                }
+                
+                # Extract info and download in a single pass
+                info = ydl.extract_info(url, download=True)
+                
+                if not info:
+                    raise Exception("Could not extract track information")
+                
+                filepath = ydl.prepare_filename(info)
+                
+                if not os.path.exists(filepath):
+                    # Over max_filesize, yt-dlp aborts the download without
+                    # raising, so a missing file means the track was too large
+                    if ydl.params.get('max_filesize'):
+                        raise FileTooLargeError(f"Track is larger than {MAX_FILE_SIZE} bytes")
+                    raise FileNotFoundError(f"Downloaded file not found: {filepath}")
+                
+                return filepath, info
+                
             except Exception as e:
-                logger.error(f"Download error: {e}")
+                logger.error("Download error: %s", e)
                 raise
         
-        return await loop.run_in_executor(None, _download)
+        return await loop.run_in_executor(download_pool, _download)
 
 # Initialize downloader
 downloader = SoundCloudDownloader()
@@ -184,97 +272,132 @@ async def help_handler(message: Message):
     """
     await message.answer(help_text)
 
-@dp.message(F.text.regexp(SOUNDCLOUD_REGEX))
+async def is_soundcloud_url(message: Message) -> bool:
+    """Check whether the message starts with a SoundCloud track URL."""
+    text = message.text
+    # Cheap prefix check so most messages never reach the regex engine
+    if not text or text[:4].lower() != 'http':
+        return False
+    return SOUNDCLOUD_REGEX.match(text) is not None
+
+@dp.message(is_soundcloud_url)
 async def soundcloud_handler(message: Message):
     """Handle SoundCloud URLs."""
     url = message.text.strip()
+    cache_key = make_cache_key(url)
+    
+    # Re-send a previously uploaded track by its Telegram file_id
+    cached = await get_cached_track(cache_key)
+    if cached:
+        try:
+            await message.answer_audio(
+                audio=cached["file_id"],
+                caption=cached["caption"],
+                title=cached["info"]["title"],
+                performer=cached["info"]["uploader"],
+                duration=cached["info"]["duration"]
+            )
+            return
+        except Exception as e:
+            logger.error("Failed to send cached track: %s", e)
+            file_id_cache.pop(cache_key, None)
+            await asyncio.to_thread(track_cache.delete, cache_key)
+    
+    # Show "sending audio..." in the chat while the track is processed
+    await bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.UPLOAD_VOICE)
     
-    # Send initial status message
-    status_message = await message.answer("🔄 <b>Начинаю загрузку...</b>\nПожалуйста, подождите.")
+    file_stem = uuid.uuid4().hex
     
     try:
-        # Create temporary directory
-        with tempfile.TemporaryDirectory() as temp_dir:
-            await status_message.edit_text("📥 <b>Загружаю трек с SoundCloud...</b>")
-            
-            # Download the track
-            filepath, info = await downloader.download_track(url, temp_dir)
-            
-            # Verify file exists
-            if not os.path.exists(filepath):
-                await status_message.edit_text("❌ <b>Ошибка:</b> Не удалось загрузить файл.")
-                return
-            
-            # Check file size
-            file_size = os.path.getsize(filepath)
-            
-            if file_size > 50 * 1024 * 1024:  # 50MB limit
-                await status_message.edit_text(
-                    "❌ <b>Ошибка:</b> Файл слишком большой для отправки через Telegram (>50MB)."
-                )
-                return
-            
-            if file_size == 0:
-                await status_message.edit_text(
-                    "❌ <b>Ошибка:</b> Загруженный файл пуст."
-                )
-                return
-            
-            await status_message.edit_text("📤 <b>Отправляю аудиофайл...</b>")
-            
-            # Read file data
-            with open(filepath, 'rb') as audio_file:
-                audio_data = audio_file.read()
-            
-            # Extract metadata
-            title = info.get('title', 'Неизвестный трек')
-            uploader = info.get('uploader', 'Неизвестный исполнитель')
-            duration = info.get('duration', 0)
-            
-            # Format duration
-            if duration and isinstance(duration, (int, float)):
-                duration = int(duration)
-                minutes = duration // 60
-                seconds = duration % 60
-                duration_str = f"{minutes:02d}:{seconds:02d}"
-            else:
-                duration_str = "Неизвестно"
-                duration = None
-            
-            # Create audio file object
-            audio_file_obj = BufferedInputFile(
-                audio_data,
-                filename=f"{downloader.sanitize_filename(title)}.mp3"
+        # Download the track
+        filepath, info = await downloader.download_track(url, file_stem)
+        
+        # Verify file exists and check its size with a single stat
+        try:
+            file_size = os.stat(filepath).st_size
+        except FileNotFoundError:
+            await message.answer("❌ <b>Ошибка:</b> Не удалось загрузить файл.")
+            return
+        
+        # Defensive check for downloads without a known size (e.g. HLS)
+        if file_size > MAX_FILE_SIZE:
+            raise FileTooLargeError(f"Track is larger than {MAX_FILE_SIZE} bytes")
+        
+        if file_size == 0:
+            await message.answer(
+                "❌ <b>Ошибка:</b> Загруженный файл пуст."
             )
-            
-            # Prepare caption
-            caption = f"""
+            return
+        
+        # Extract metadata
+        title = info.get('title', 'Неизвестный трек')
+        uploader = info.get('uploader', 'Неизвестный исполнитель')
+        duration = int(info.get('duration') or 0) or None
+        
+        # Format duration
+        if duration:
+            minutes, seconds = divmod(duration, 60)
+            duration_str = f"{minutes:02d}:{seconds:02d}"
+        else:
+            duration_str = "Неизвестно"
+        
+        # Stream the file from disk instead of reading it into memory,
+        # keeping the real extension in case a non-MP3 fallback was picked
+        audio_file_obj = FSInputFile(
+            filepath,
+            filename=f"{downloader.sanitize_filename(title)}.{info.get('ext', 'mp3')}",
+            chunk_size=UPLOAD_CHUNK_SIZE
+        )
+        
+        # Prepare caption
+        caption = f"""
 🎵 <b>{title}</b>
 👤 <b>Исполнитель:</b> {uploader}
 ⏱ <b>Длительность:</b> {duration_str}
 💾 <b>Размер:</b> {file_size / (1024*1024):.1f} MB
 
 <i>Загружено с SoundCloud</i>
-            """.strip()
-            
-            # Send audio file
-            await message.answer_audio(
-                audio=audio_file_obj,
-                caption=caption,
-                title=title,
-                performer=uploader,
-                duration=duration if duration else None
-            )
-            
-            # Delete status message
-            await status_message.delete()
-            
+        """.strip()
+        
+        # Send audio file
+        sent_message = await message.answer_audio(
+            audio=audio_file_obj,
+            caption=caption,
+            title=title,
+            performer=uploader,
+            duration=duration
+        )
+        
+        # Remember the uploaded file for future requests
+        if sent_message.audio:
+            entry = {
+                "file_id": sent_message.audio.file_id,
+                "caption": caption,
+                "info": {
+                    "title": title,
+                    "uploader": uploader,
+                    "duration": duration,
+                },
+            }
+            remember_track(cache_key, entry)
+            # The track is already delivered, so a cache failure must not
+            # turn into an error reply
+            try:
+                await asyncio.to_thread(
+                    track_cache.set,
+                    cache_key,
+                    entry,
+                    expire=TRACK_CACHE_TTL
+                )
+            except Exception as e:
+                logger.error("Failed to cache track: %s", e)
+        
     except yt_dlp.DownloadError as e:
-        logger.error(f"yt-dlp download error: {e}")
+        logger.error("yt-dlp download error: %s", e)
         error_message = str(e).lower()
         
         if "private" in error_message or "not available" in error_message:
-            await status_message.edit_text(
+            await message.answer(
                 "❌ <b>Ошибка доступа к треку</b>\n\n"
                 "Возможные причины:\n"
                 "• Трек является приватным\n"
@@ -283,7 +406,7 @@ async def soundcloud_handler(message: Message):
                 "Попробуйте другую ссылку."
             )
         else:
-            await status_message.edit_text(
+            await message.answer(
                 "❌ <b>Ошибка загрузки с SoundCloud</b>\n\n"
                 "Возможные причины:\n"
                 "• Проблемы с доступом к SoundCloud\n"
@@ -292,24 +415,29 @@ async def soundcloud_handler(message: Message):
                 "Попробуйте еще раз через несколько минут."
             )
             
+    except FileTooLargeError:
+        await message.answer(
+            "❌ <b>Ошибка:</b> Файл слишком большой для отправки через Telegram (>50MB)."
+        )
+        
     except FileNotFoundError:
         logger.error("Downloaded file not found")
-        await status_message.edit_text(
+        await message.answer(
             "❌ <b>Ошибка:</b> Загруженный файл не найден.\n"
             "Попробуйте еще раз."
         )
         
     except asyncio.TimeoutError:
         logger.error("Download timeout")
-        await status_message.edit_text(
+        await message.answer(
             "❌ <b>Таймаут загрузки</b>\n\n"
             "Загрузка заняла слишком много времени.\n"
             "Попробуйте еще раз или выберите другой трек."
         )
         
     except Exception as e:
-        logger.error(f"Unexpected error during track download: {e}")
-        await status_message.edit_text(
+        logger.error("Unexpected error during track download: %s", e)
+        await message.answer(
             "❌ <b>Произошла неожиданная ошибка</b>\n\n"
             "Возможные причины:\n"
             "• Временные проблемы с сервисом\n"
@@ -317,13 +445,15 @@ async def soundcloud_handler(message: Message):
             "• Неподдерживаемый формат трека\n\n"
             "Попробуйте еще раз через несколько минут."
         )
+    finally:
+        # Remove the downloaded file along with any partial leftovers
+        for leftover in Path(SCRATCH_DIR).glob(f"{file_stem}.*"):
+            leftover.unlink(missing_ok=True)
 
 @dp.message(F.text)
 async def text_handler(message: Message):
     """Handle regular text messages."""
-    text = message.text.lower()
-    
-    if any(word in text for word in ['soundcloud', 'ссылка', 'скачать', 'трек']):
+    if KEYWORD_REGEX.search(message.text):
         await message.answer(
             "🔗 <b>Отправьте ссылку на SoundCloud</b>\n\n"
             "Пример правильной ссылки:\n"
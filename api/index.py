@@ -3,21 +3,27 @@ from aiogram import Bot, Dispatcher, types
 from aiogram.enums import ParseMode
 from aiogram.fsm.storage.memory import MemoryStorage
 import os
-import json
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
 # Import bot handlers
-from api.bot import dp, bot
+from api.bot import dp, bot, download_pool, downloader
 
 # Initialize FastAPI app
 app = FastAPI()
 
 # Webhook settings
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-WEBHOOK_PATH = f"/api/webhook"
+WEBHOOK_PATH = "/api/webhook"
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """Release the download thread pool, yt-dlp instances and the bot's HTTP session."""
+    download_pool.shutdown(wait=False)
+    downloader.close()
+    await bot.session.close()
 
 @app.get("/")
 async def root():
@@ -36,18 +42,16 @@ async def root():
             "message": f"Bot initialization failed: {str(e)}"
         }
 
-@app.post("/api/webhook")
+@app.post(WEBHOOK_PATH)
 async def webhook_handler(request: Request):
     """Handle webhook requests from Telegram."""
     try:
         # Get the raw request body
         body = await request.body()
         
-        # Parse JSON
-        update_data = json.loads(body)
-        
-        # Create Update object
-        update = types.Update.model_validate(update_data)
+        # Parse and validate the Update straight from the JSON bytes, binding
+        # the bot so feed_update doesn't re-validate it
+        update = types.Update.model_validate_json(body, context={"bot": bot})
         
         # Process the update
         await dp.feed_update(bot=bot, update=update)
@@ -67,7 +71,7 @@ async def set_webhook():
         if not vercel_url:
             return {"error": "VERCEL_URL environment variable not set"}
         
-        webhook_url = f"https://{vercel_url}/api/webhook"
+        webhook_url = f"https://{vercel_url}{WEBHOOK_PATH}"
         
         # Set webhook
         await bot.set_webhook(url=webhook_url)